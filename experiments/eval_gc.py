@@ -58,11 +58,8 @@ FIXED_STD = np.array([0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0])
 ##############################################################################
 
 
-def stack_obs(obs):
-    dict_list = {k: [dic[k] for dic in obs] for k in obs[0]}
-    return jax.tree_map(
-        lambda x: np.stack(x), dict_list, is_leaf=lambda x: type(x) == list
-    )
+def stack_obs(obs_hist):
+    return {k: np.stack(v) for k, v in obs_hist.items()}
 
 
 def load_checkpoint(checkpoint_weights_path, checkpoint_config_path):
@@ -237,7 +234,11 @@ def main(_):
         goals = []
         t = 0
         if obs_horizon is not None:
-            obs_hist = deque(maxlen=obs_horizon)
+            # per-key histories so that stacking doesn't have to regroup them
+            obs_hist = {
+                "image": deque(maxlen=obs_horizon),
+                "proprio": deque(maxlen=obs_horizon),
+            }
         # keep track of our own gripper state to implement sticky gripper
         is_gripper_closed = False
         num_consecutive_gripper_change_actions = 0
@@ -253,10 +254,11 @@ def main(_):
                     obs = {"image": image_obs, "proprio": obs["state"]}
                     goal_obs = {"image": image_goal}
                     if obs_horizon is not None:
-                        if len(obs_hist) == 0:
-                            obs_hist.extend([obs] * obs_horizon)
-                        else:
-                            obs_hist.append(obs)
+                        for k, v in obs.items():
+                            if len(obs_hist[k]) == 0:
+                                obs_hist[k].extend([v] * obs_horizon)
+                            else:
+                                obs_hist[k].append(v)
                         obs = stack_obs(obs_hist)
 
                     last_tstep = time.time()
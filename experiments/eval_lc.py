@@ -1,17 +1,22 @@
 import sys
 import os
+import queue
+import threading
 import time
 from datetime import datetime
 import traceback
-from collections import deque
-import json
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 from absl import app, flags, logging
 
 import numpy as np
+import orjson
 import tensorflow as tf
 
 import jax
+import jax.numpy as jnp
+from jax.experimental.compilation_cache import compilation_cache
 import imageio
 
 from flax.training import checkpoints
@@ -42,6 +47,16 @@ flags.DEFINE_bool("blocking", False, "Use the blocking controller")
 flags.DEFINE_spaceseplist("initial_eep", None, "Initial position")
 flags.DEFINE_integer("act_exec_horizon", 1, "Action sequence length")
 flags.DEFINE_bool("deterministic", True, "Whether to sample action deterministically")
+flags.DEFINE_bool(
+    "overlap_inference",
+    False,
+    "Compute the next action while the previous one executes, at the cost of "
+    "acting on an observation that is one step old. Requires --blocking, since "
+    "the non-blocking controller already returns before the next inference",
+)
+flags.DEFINE_bool(
+    "bfloat16", False, "Run the encoder and policy in bfloat16 for inference"
+)
 
 ##############################################################################
 
@@ -52,26 +67,105 @@ STICKY_GRIPPER_NUM_STEPS = 1
 WORKSPACE_BOUNDS = np.array([[0.1, -0.15, -0.1, -1.57, 0], [0.45, 0.25, 0.25, 1.57, 0]])
 CAMERA_TOPICS = [IMTopic("/blue/image_raw")]
 FIXED_STD = np.array([0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0])
+# images arrive from the env channels-first and are permuted to the layout the
+# encoders consume inside the jitted policy, where XLA can fuse the transpose
+# into the first conv. encoders preferring another layout should change this
+ENV_IMAGE_LAYOUT = "CHW"
+ENCODER_IMAGE_LAYOUT = "HWC"
+# size of the instruction embedding the policies are compiled for
+LANGUAGE_EMBEDDING_DIM = 512
 
 ##############################################################################
 
+# skip sampling action noise entirely when it would be all zeros
+ADD_NOISE = bool(np.any(FIXED_STD))
+
+
+def convert_layout(image, src_layout, dst_layout):
+    """Permutes the trailing image axes of `image` from `src_layout` to `dst_layout`."""
+    num_leading = image.ndim - len(src_layout)
+    perm = [num_leading + src_layout.index(axis) for axis in dst_layout]
+    return jnp.transpose(image, (*range(num_leading), *perm))
+
 
-def stack_obs(obs):
-    dict_list = {k: [dic[k] for dic in obs] for k in obs[0]}
+class VideoWriter:
+    """Encodes frames to a video file on a background thread.
+
+    The video is written to a hidden file next to `path` and only moved to
+    `path` once it is closed.
+    """
+
+    def __init__(self, path, fps):
+        self.path = path
+        self.tmp_path = os.path.join(
+            os.path.dirname(path), "." + os.path.basename(path)
+        )
+        self.writer = imageio.get_writer(self.tmp_path, fps=fps)
+        self.frames = queue.Queue()
+        self.thread = threading.Thread(target=self._write_frames, daemon=True)
+        self.thread.start()
+
+    def _write_frames(self):
+        while True:
+            frame = self.frames.get()
+            if frame is None:
+                break
+            # frames are recorded channels-first
+            self.writer.append_data(np.ascontiguousarray(frame.transpose(1, 2, 0)))
+
+    def append(self, frame):
+        self.frames.put(frame)
+
+    def close(self):
+        self.frames.put(None)
+        self.thread.join()
+        self.writer.close()
+        # nothing is written if the rollout failed before its first step
+        if os.path.exists(self.tmp_path):
+            os.replace(self.tmp_path, self.path)
+
+
+def apply_sticky_gripper(gripper_actions, is_closed, num_changes):
+    """Runs the sticky gripper state machine over a sequence of gripper actions.
+
+    Overwrites `gripper_actions` in place with the gripper commands to execute
+    and returns the updated `(is_closed, num_changes)` state. The update is
+    written without branches so that toggling gripper actions take the same
+    path.
+    """
+    for i in range(len(gripper_actions)):
+        change = int(gripper_actions[i] < 0.5) ^ is_closed
+        num_changes = (num_changes + 1) * change
+        flip = int(num_changes >= STICKY_GRIPPER_NUM_STEPS)
+        is_closed ^= flip
+        num_changes *= 1 - flip
+        gripper_actions[i] = 1 - is_closed
+    return is_closed, num_changes
+
+
+@partial(jax.jit, donate_argnums=0)
+def push_obs(obs_hist, obs):
+    """Drops the oldest entry of each history in `obs_hist` and appends `obs`."""
     return jax.tree_map(
-        lambda x: np.stack(x), dict_list, is_leaf=lambda x: type(x) == list
+        lambda hist, x: jnp.concatenate([hist[1:], x[None].astype(hist.dtype)]),
+        obs_hist,
+        obs,
     )
 
 
 def load_checkpoint(checkpoint_weights_path, checkpoint_config_path):
-    with open(checkpoint_config_path, "r") as f:
-        config = json.load(f)
+    with open(checkpoint_config_path, "rb") as f:
+        config = orjson.loads(f.read())
 
     # create encoder from wandb config
-    encoder_def = encoders[config["encoder"]](**config["encoder_kwargs"])
+    encoder_kwargs = dict(config["encoder_kwargs"])
+    if FLAGS.bfloat16:
+        encoder_kwargs["dtype"] = jnp.bfloat16
+    encoder_def = encoders[config["encoder"]](**encoder_kwargs)
 
-    act_pred_horizon = config["dataset_kwargs"].get("act_pred_horizon")
-    obs_horizon = config["dataset_kwargs"].get("obs_horizon")
+    dataset_kwargs = config["dataset_kwargs"]
+    act_pred_horizon = dataset_kwargs.get("act_pred_horizon")
+    obs_horizon = dataset_kwargs.get("obs_horizon")
 
     if act_pred_horizon is not None:
         example_actions = np.zeros((1, act_pred_horizon, 7), dtype=np.float32)
@@ -91,7 +185,7 @@ def load_checkpoint(checkpoint_weights_path, checkpoint_config_path):
 
     example_batch = {
         "observations": example_obs,
-        "goals": {"language": np.zeros((1, 512), dtype=np.float32)},
+        "goals": {"language": np.zeros((1, LANGUAGE_EMBEDDING_DIM), dtype=np.float32)},
         "actions": example_actions,
     }
 
@@ -109,30 +203,94 @@ def load_checkpoint(checkpoint_weights_path, checkpoint_config_path):
 
     # load action metadata from wandb
     action_proprio_metadata = config["bridgedata_config"]["action_proprio_metadata"]
-    action_mean = np.array(action_proprio_metadata["action"]["mean"])
-    action_std = np.array(action_proprio_metadata["action"]["std"])
+    action_mean = jnp.asarray(action_proprio_metadata["action"]["mean"], jnp.float32)
+    action_std = jnp.asarray(action_proprio_metadata["action"]["std"], jnp.float32)
 
     # hydrate agent with parameters from checkpoint
     agent = checkpoints.restore_checkpoint(checkpoint_weights_path, agent)
 
-    def get_action(obs, goal_obs):
-        nonlocal rng
+    if FLAGS.bfloat16:
+        # halve the parameter bandwidth; the action metadata stays in float32
+        def to_bf16(p):
+            return p.astype(jnp.bfloat16) if p.dtype == jnp.float32 else p
+
+        agent = agent.replace(
+            state=agent.state.replace(params=jax.tree_map(to_bf16, agent.state.params))
+        )
+
+    # the restored params are host arrays; move them to device once so that
+    # they aren't re-uploaded on every policy call
+    agent = jax.device_put(agent)
+
+    # the agent is passed as an argument (rather than closed over) so that its
+    # parameters aren't baked into the compiled executable as constants
+    @jax.jit
+    def sample_actions(agent, obs, goal_obs, rng):
         rng, key = jax.random.split(rng)
-        action = jax.device_get(
-            agent.sample_actions(obs, goal_obs, seed=key, argmax=FLAGS.deterministic)
+        if obs_horizon is not None:
+            # LCEncodingWrapper folds the history axis into the batch axis, so
+            # the whole history goes through the encoder in one forward pass
+            obs = jax.tree_map(lambda x: x[None], obs)
+        obs = {
+            **obs,
+            "image": convert_layout(
+                obs["image"], ENV_IMAGE_LAYOUT, ENCODER_IMAGE_LAYOUT
+            ),
+        }
+        actions = agent.sample_actions(
+            obs, goal_obs, seed=key, argmax=FLAGS.deterministic
         )
-        action = action * action_std + action_mean
-        return action
+        # denormalize on device so it fuses with the policy head
+        actions = actions.astype(jnp.float32) * action_std + action_mean
+        return actions, rng
+
+    # compile ahead of time with the shapes seen during rollouts so that
+    # neither the first control step nor switching policies stalls on it
+    proprio_dim = len(action_proprio_metadata["proprio"]["mean"])
+    hist_shape = (1 if obs_horizon is None else obs_horizon,)
+    warmup_obs = {
+        "image": np.zeros(
+            (*hist_shape, 3, FLAGS.im_size, FLAGS.im_size), dtype=np.uint8
+        ),
+        "proprio": np.zeros((*hist_shape, proprio_dim), dtype=np.float32),
+    }
+    sample_actions = sample_actions.lower(
+        agent, warmup_obs, example_batch["goals"], rng
+    ).compile()
+    # run once so that XLA finishes setting up the executable
+    jax.block_until_ready(
+        sample_actions(agent, warmup_obs, example_batch["goals"], rng)
+    )
+    # also compile the history update for this history length. the history
+    # argument is donated, so it gets a throwaway copy
+    jax.block_until_ready(
+        push_obs(jax.device_put(warmup_obs), {k: v[0] for k, v in warmup_obs.items()})
+    )
+
+    def get_action(obs, goal_obs):
+        nonlocal rng
+        action, rng = sample_actions(agent, obs, goal_obs, rng)
+        # copy, since the rollout modifies actions in place
+        return np.array(jax.device_get(action))
 
     text_processor = text_processors[config["text_processor"]](
         **config["text_processor_kwargs"]
     )
 
-    return get_action, text_processor, obs_horizon
+    return get_action, text_processor, obs_horizon, proprio_dim
 
 
 def main(_):
     assert len(FLAGS.checkpoint_weights_path) == len(FLAGS.checkpoint_config_path)
+    assert (
+        FLAGS.blocking or not FLAGS.overlap_inference
+    ), "--overlap_inference only has an effect with --blocking"
+
+    # persist compiled policies across runs to skip recompiling on restart
+    compilation_cache.initialize_cache(
+        os.path.expanduser(os.environ.get("JAX_CACHE", "~/.cache/jax_bridge"))
+    )
+    jax.config.update("jax_persistent_cache_min_compile_time_secs", 0)
 
     # policies is a dict from run_name to get_action function
     policies = {}
@@ -145,6 +303,7 @@ def main(_):
         policies[f"{run_name}-{checkpoint_num}"] = load_checkpoint(
             checkpoint_weights_path, checkpoint_config_path
         )
+    policy_names = tuple(policies.keys())
 
     if FLAGS.initial_eep is not None:
         assert isinstance(FLAGS.initial_eep, list)
@@ -173,17 +332,17 @@ def main(_):
     # instruction sampling loop
     while True:
         # ask for which policy to use
-        if len(policies) == 1:
+        if len(policy_names) == 1:
             policy_idx = 0
             input("Press [Enter] to start.")
         else:
             print("policies:")
-            for i, name in enumerate(policies.keys()):
+            for i, name in enumerate(policy_names):
                 print(f"{i}) {name}")
             policy_idx = int(input("select policy: "))
 
-        policy_name = list(policies.keys())[policy_idx]
-        get_action, text_processor, obs_horizon = policies[policy_name]
+        policy_name = policy_names[policy_idx]
+        get_action, text_processor, obs_horizon, proprio_dim = policies[policy_name]
 
         # ask for new instruction
         if instruction is None:
@@ -192,6 +351,17 @@ def main(_):
             ch = input("New instruction? [y/n]")
         if ch == "y":
             instruction = text_processor.encode(input("Instruction?"))
+            # transfer the encoded instruction once rather than every step.
+            # the policy is compiled ahead of time for a batched float32
+            # embedding, so the goal has to match that exactly; reshape fails
+            # here, outside the rollout, if the text processor disagrees
+            goal_obs = {
+                "language": jax.device_put(
+                    np.asarray(instruction, np.float32).reshape(
+                        1, LANGUAGE_EMBEDDING_DIM
+                    )
+                )
+            }
 
         try:
             env.reset()
@@ -211,84 +381,150 @@ def main(_):
 
         # do rollout
         obs = env.current_obs()
-        last_tstep = time.time()
-        images = []
+        # the policy is compiled for a fixed proprio size; check it here rather
+        # than failing on every step inside the rollout
+        assert obs["state"].shape[-1] == proprio_dim, (
+            f"env proprio has size {obs['state'].shape[-1]} but the policy was "
+            f"compiled for {proprio_dim}"
+        )
+        last_tstep = time.monotonic()
         t = 0
-        if obs_horizon is not None:
-            obs_hist = deque(maxlen=obs_horizon)
+        video_writer = None
+        if FLAGS.video_save_path is not None:
+            os.makedirs(FLAGS.video_save_path, exist_ok=True)
+            curr_time = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+            video_writer = VideoWriter(
+                os.path.join(
+                    FLAGS.video_save_path,
+                    f"{curr_time}_{policy_name}_sticky_{STICKY_GRIPPER_NUM_STEPS}.mp4",
+                ),
+                fps=1.0 / STEP_DURATION * 3,
+            )
+        # the observation history lives on device, oldest frame first, and is
+        # updated in place. without an observation horizon the single frame
+        # doubles as a batch of one
+        hist_len = 1 if obs_horizon is None else obs_horizon
+        frame = np.empty((3, FLAGS.im_size, FLAGS.im_size), np.uint8)
+        if ADD_NOISE:
+            # the inner loop may overshoot num_timesteps by a partial chunk
+            noise = np.random.normal(
+                0.0,
+                FIXED_STD,
+                size=(FLAGS.num_timesteps + FLAGS.act_exec_horizon, len(FIXED_STD)),
+            )
         # keep track of our own gripper state to implement sticky gripper
-        is_gripper_closed = False
+        is_gripper_closed = 0
         num_consecutive_gripper_change_actions = 0
+        step_future = None
+        # whether obs hasn't been pushed into the history yet. with
+        # overlap_inference a step may still be running when the next action
+        # is computed, in which case the history is already up to date
+        obs_is_new = True
+        if FLAGS.overlap_inference:
+            # runs env steps in the background during this rollout
+            step_executor = ThreadPoolExecutor(max_workers=1)
         try:
             while t < FLAGS.num_timesteps:
-                if time.time() > last_tstep + STEP_DURATION or FLAGS.blocking:
-                    image_obs = (
-                        obs["image"]
-                        .reshape(3, FLAGS.im_size, FLAGS.im_size)
-                        .transpose(1, 2, 0)
-                        * 255
-                    ).astype(np.uint8)
-                    obs = {"image": image_obs, "proprio": obs["state"]}
-                    goal_obs = {"language": instruction}
-                    if obs_horizon is not None:
-                        if len(obs_hist) == 0:
-                            obs_hist.extend([obs] * obs_horizon)
-                        else:
-                            obs_hist.append(obs)
-                        obs = stack_obs(obs_hist)
-
-                    last_tstep = time.time()
-
-                    actions = get_action(obs, goal_obs)
-                    if len(actions.shape) == 1:
-                        actions = actions[None]
-                    for i in range(FLAGS.act_exec_horizon):
-                        action = actions[i]
-                        action += np.random.normal(0, FIXED_STD)
-
-                        # sticky gripper logic
-                        if (action[-1] < 0.5) != is_gripper_closed:
-                            num_consecutive_gripper_change_actions += 1
-                        else:
-                            num_consecutive_gripper_change_actions = 0
-
-                        if (
-                            num_consecutive_gripper_change_actions
-                            >= STICKY_GRIPPER_NUM_STEPS
-                        ):
-                            is_gripper_closed = not is_gripper_closed
-                            num_consecutive_gripper_change_actions = 0
-
-                        action[-1] = 0.0 if is_gripper_closed else 1.0
-
-                        # remove degrees of freedom
-                        if NO_PITCH_ROLL:
-                            action[3] = 0
-                            action[4] = 0
-                        if NO_YAW:
-                            action[5] = 0
-
-                        # perform environment step
+                if not FLAGS.blocking:
+                    # sleep until the next step is due instead of polling
+                    sleep_for = last_tstep + STEP_DURATION - time.monotonic()
+                    if sleep_for > 0:
+                        time.sleep(sleep_for)
+                if obs_is_new:
+                    # scale and cast straight into uint8, avoiding a float
+                    # temporary the size of the image. the frame stays
+                    # channels-first; the policy permutes it
+                    np.multiply(
+                        obs["image"].reshape(3, FLAGS.im_size, FLAGS.im_size),
+                        255,
+                        out=frame,
+                        casting="unsafe",
+                    )
+                    new_obs = {"image": frame, "proprio": obs["state"]}
+                    if t == 0:
+                        obs_hist = jax.tree_map(
+                            lambda x: jax.device_put(
+                                np.repeat(x[None], hist_len, axis=0)
+                            ),
+                            new_obs,
+                        )
+                    else:
+                        obs_hist = push_obs(obs_hist, new_obs)
+                    image_obs = frame.copy()
+                    obs_is_new = False
+
+                last_tstep = time.monotonic()
+                # the env times its observations against the wall clock
+                obs_tstamp = time.time() + STEP_DURATION
+
+                actions = get_action(obs_hist, goal_obs)[0]
+                if len(actions.shape) == 1:
+                    actions = actions[None]
+                assert len(actions) >= FLAGS.act_exec_horizon, (
+                    f"policy predicts {len(actions)} actions but "
+                    f"act_exec_horizon is {FLAGS.act_exec_horizon}"
+                )
+                # post-process the whole executed chunk at once
+                actions = actions[: FLAGS.act_exec_horizon]
+                if ADD_NOISE:
+                    actions += noise[t : t + len(actions)]
+
+                # sticky gripper logic
+                (
+                    is_gripper_closed,
+                    num_consecutive_gripper_change_actions,
+                ) = apply_sticky_gripper(
+                    actions[:, -1],
+                    is_gripper_closed,
+                    num_consecutive_gripper_change_actions,
+                )
+
+                # remove degrees of freedom
+                if NO_PITCH_ROLL:
+                    actions[:, 3] = 0
+                    actions[:, 4] = 0
+                if NO_YAW:
+                    actions[:, 5] = 0
+
+                for action in actions:
+                    # perform environment step. with overlap_inference the
+                    # step keeps running while the next action is computed
+                    # from the observation that preceded it
+                    if FLAGS.overlap_inference:
+                        if step_future is not None:
+                            obs, _, _, _ = step_future.result()
+                            obs_is_new = True
+                        step_future = step_executor.submit(
+                            env.step,
+                            action,
+                            obs_tstamp,
+                            blocking=FLAGS.blocking,
+                        )
+                    else:
                         obs, _, _, _ = env.step(
-                            action, last_tstep + STEP_DURATION, blocking=FLAGS.blocking
+                            action,
+                            obs_tstamp,
+                            blocking=FLAGS.blocking,
                         )
+                        obs_is_new = True
 
-                        # save image
-                        images.append(image_obs)
+                    # save image
+                    if video_writer is not None:
+                        video_writer.append(image_obs)
 
-                        t += 1
+                    t += 1
+            if step_future is not None:
+                step_future.result()
         except Exception as e:
             print(traceback.format_exc(), file=sys.stderr)
-
-        # save video
-        if FLAGS.video_save_path is not None:
-            os.makedirs(FLAGS.video_save_path, exist_ok=True)
-            curr_time = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-            save_path = os.path.join(
-                FLAGS.video_save_path,
-                f"{curr_time}_{policy_name}_sticky_{STICKY_GRIPPER_NUM_STEPS}.mp4",
-            )
-            imageio.mimsave(save_path, images, fps=1.0 / STEP_DURATION * 3)
+        finally:
+            # never reset the env while a step is still executing
+            if FLAGS.overlap_inference:
+                step_executor.shutdown(wait=True)
+
+        # finish writing video
+        if video_writer is not None:
+            video_writer.close()
 
 
 if __name__ == "__main__":